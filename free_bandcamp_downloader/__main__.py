@@ -35,286 +35,62 @@ Formats:
 """
 
 import atexit
-import dataclasses
-import glob
-import html
-import json
 import os
+import pickle
 import pprint
-import re
 import sys
-import time
-import zipfile
 from configparser import ConfigParser
-from dataclasses import dataclass
-from typing import Dict, Set
-from urllib.parse import urljoin, urlsplit
-
-import mutagen
-import pyrfc6266
-import requests
-import secmail
-from bs4 import BeautifulSoup
-from docopt import docopt
-from tqdm import tqdm
 
 from free_bandcamp_downloader import __version__, logger
 
 
-@dataclass
-class BCFreeDownloaderOptions:
-    country: str = None
-    zipcode: str = None
-    email: str = None
-    format: str = None
-    dir: str = None
-
-
-@dataclass
-class BCFreeDownloaderAlbumData:
-    about: str = None
-    credits: str = None
-    tags: str = None
-
-
-class BCFreeDownloadError(Exception):
-    pass
-
-
-class BCFreeDownloader:
-    CHUNK_SIZE = 1024 * 1024
-    LINK_REGEX = re.compile(r'<a href="(?P<url>[^"]*)">')
-    RETRY_URL_REGEX = re.compile(r'"retry_url":"(?P<retry_url>[^"]*)"')
-    FORMATS = {
-        "FLAC": "flac",
-        "V0MP3": "mp3-v0",
-        "320MP3": "mp3-320",
-        "AAC": "aac-hi",
-        "Ogg": "vorbis",
-        "ALAC": "alac",
-        "WAV": "wav",
-        "AIFF": "aiff-lossless",
-    }
-
-    def __init__(
-        self,
-        options: BCFreeDownloaderOptions,
-        config_dir: str,
-        download_history_file: str,
-        unzip: bool = True,
-    ):
-        self.options = options
-        self.config_dir = config_dir
-        self.download_history_file = download_history_file
-        self.downloaded: Set[str] = set()
-        self.mail_session = None
-        self.mail_album_data: Dict[str, BCFreeDownloaderAlbumData] = {}
-        self.unzip = unzip
-        self.session = None
-        self._init_email()
-        self._init_downloaded()
-        self._init_session()
-
-    def _init_email(self):
-        if not self.options.email or self.options.email == "auto":
-            self.mail_session = secmail.Client(self.config_dir)
-            self.options.email = self.mail_session.random_email(1, "1secmail.com")[0]
-
-    def _init_downloaded(self):
-        if self.download_history_file:
-            with open(self.download_history_file, "r") as f:
-                for line in f:
-                    self.downloaded.add(line.strip())
-
-    def _init_session(self):
-        self.session = requests.Session()
-
-    def _download_file(
-        self,
-        download_page_url: str,
-        format: str,
-        album_data: BCFreeDownloaderAlbumData = None,
-    ) -> str:
-        r = self.session.get(download_page_url)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        album_url = soup.find("div", class_="download-artwork").find("a").attrs["href"]
-        if album_data is None:
-            album_data = self.mail_album_data[album_url]
-
-        data = json.loads(soup.find("div", {"id": "pagedata"}).attrs["data-blob"])
-        download_url = data["digital_items"][0]["downloads"][self.FORMATS[format]][
-            "url"
-        ]
+class BCFreeDownloaderConfig:
+    def __init__(self, config_path: str, cache_path: str = None):
+        self.config_path = config_path
+        self.cache_path = cache_path
+        self.parser = ConfigParser()
+        if not self._read_cache():
+            self.parser.read(config_path)
+            self._write_cache()
+        atexit.register(self.save)
 
-        def download(download_url: str) -> str:
-            with self.session.get(download_url, stream=True) as r:
-                r.raise_for_status()
-                size = int(r.headers["content-length"])
-                name = pyrfc6266.requests_response_to_filename(r)
-                file_name = os.path.join(self.options.dir, name)
-                with tqdm(total=size, unit="iB", unit_scale=True) as pbar:
-                    with open(file_name, "wb") as f:
-                        for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
-                            f.write(chunk)
-                            pbar.update(len(chunk))
-                return file_name
+    def _config_stat(self):
+        st = os.stat(self.config_path)
+        return (st.st_mtime_ns, st.st_size)
 
+    def _read_cache(self):
+        if not self.cache_path:
+            return False
         try:
-            file_name = download(download_url)
-        except:
-            statdownload_url = download_url.replace("/download/", "/statdownload/")
-            with self.session.get(statdownload_url) as r:
-                r.raise_for_status()
-                download_url = self.RETRY_URL_REGEX.search(r.text).group("retry_url")
-            file_name = download(download_url)
-
-        logger.info(f"Downloaded {file_name}")
-
-        if file_name.endswith("zip") and self.unzip:
-            # Unzip archive
-            dir_name = file_name[:-4]
-            with zipfile.ZipFile(file_name, "r") as f:
-                f.extractall(dir_name)
-            logger.info(f"Unzipped to {dir_name}. Use --no-unzip to prevent this")
-            os.remove(file_name)
-            files = glob.glob(os.path.join(dir_name, "*"))
-        else:
-            files = [file_name]
-        # Tag downloaded audio files with url & comment
-        logger.info("Setting tags...")
-        for file in files:
-            f = mutagen.File(file)
-            if f is None:
-                continue
-            f["website"] = album_url
-            if album_data.tags:
-                f["genre"] = album_data.tags
-            comment = ""
-            if album_data.about:
-                comment += album_data.about
-            if album_data.about and album_data.credits:
-                comment += "\n\n"
-            if album_data.credits:
-                comment += album_data.credits
-            f["comment"] = comment
-            f.save()
-        # successfully downloaded file, add to download history
-        self.downloaded.add(album_url)
-        if self.download_history_file:
-            with open(self.download_history_file, "a") as f:
-                f.write(f"{album_url}\n")
-
-        return album_url
-
-    @staticmethod
-    def _get_album_data_from_soup(soup: BeautifulSoup) -> BCFreeDownloaderAlbumData:
-        album_data = BCFreeDownloaderAlbumData()
-        about = soup.find("div", class_="tralbum-about")
-        album_data.about = about.get_text("\n") if about else None
-        credits = soup.find("div", class_="tralbum-credits")
-        album_data.credits = credits.get_text("\n") if credits else None
-        tags = [tag.get_text() for tag in soup.find_all("a", class_="tag")]
-        album_data.tags = ",".join(sorted(tags))
-        return album_data
-
-    def download_album(self, url: str, force: bool = False):
-        # Remove url params
-        url = urlsplit(url).geturl()
-        if url in self.downloaded and not force:
-            raise BCFreeDownloadError(
-                f"{url} already downloaded. To download anyways, use option --force"
-            )
-        r = self.session.get(url)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        album_data = self._get_album_data_from_soup(soup)
-
-        logger.debug(f"Album data: {album_data}")
-
-        tralbum_data = soup.find("script", {"data-tralbum": True}).attrs["data-tralbum"]
-        tralbum_data = json.loads(tralbum_data)
-
-        if tralbum_data["current"]["minimum_price"] == 0:
-            if tralbum_data["current"]["require_email"]:
-                logger.info(f"{url} requires email")
-                email_post_url = urljoin(url, "/email_download")
-                r = self.session.post(
-                    email_post_url,
-                    data={
-                        "encoding_name": "none",
-                        "item_id": tralbum_data["current"]["id"],
-                        "item_type": tralbum_data["current"]["type"],
-                        "address": self.options.email,
-                        "country": self.options.country,
-                        "postcode": self.options.zipcode,
+            with open(self.cache_path, "rb") as f:
+                cached = pickle.load(f)
+            if cached["key"] != self._config_stat():
+                return False
+        except Exception:
+            # any unreadable cache (missing, truncated, stale format...)
+            # just means a normal parse
+            return False
+        self.parser.read_dict({"free-bandcamp-downloader": cached["data"]})
+        return True
+
+    def _write_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            # write-then-rename so an interrupted run can never leave a
+            # half-written pickle behind
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(
+                    {
+                        "key": self._config_stat(),
+                        "data": dict(self.parser["free-bandcamp-downloader"]),
                     },
+                    f,
                 )
-                r.raise_for_status()
-                r = r.json()
-                if not r["ok"]:
-                    raise ValueError(f"Bad response when sending email address: {r}")
-                self.mail_album_data[url] = album_data
-            else:
-                logger.info(f"{url} does not require email")
-                if not tralbum_data["freeDownloadPage"]:
-                    logger.warning(
-                        "Album has no download link (probably has no tracks). Skipping..."
-                    )
-                    return
-                self._download_file(
-                    tralbum_data["freeDownloadPage"], self.options.format, album_data
-                )
-        else:
-            raise BCFreeDownloadError(f"{url} is not free")
-
-    def download_label(self, url: str, force: bool = False):
-        r = self.session.get(url)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        grid = soup.find("ol", id="music-grid")
-        albums = [li.a["href"] for li in grid.find_all("li")]
-        if grid.has_attr("data-client-items"):
-            albums += [obj["page_url"] for obj in json.loads(html.unescape(grid["data-client-items"]))]
-        for album_link in albums:
-            album_link = urljoin(url, album_link)
-            logger.info(f"Downloading {album_link}")
-            try:
-                self.download_album(album_link, force)
-            except BCFreeDownloadError as ex:
-                logger.info(ex)
-
-    def wait_for_email_downloads(self):
-        checked_ids = set()
-        while (expected_emails := len(self.mail_album_data)) > 0:
-            logger.info(f"Waiting for {expected_emails} emails from Bandcamp...")
-            time.sleep(5)
-            for email in self.mail_session.get_inbox(self.options.email):
-                if email.id not in checked_ids:
-                    checked_ids.add(email.id)
-                    if (
-                        email.from_address.endswith("@email.bandcamp.com")
-                        and "download" in email.subject
-                    ):
-                        logger.info(f'Received email "{email.subject}"')
-                        email = self.mail_session.get_message(
-                            self.options.email, email.id
-                        )
-                        match = self.LINK_REGEX.search(email.html_body)
-                        if match:
-                            download_url = match.group("url")
-                            album_url = self._download_file(
-                                download_url, self.options.format
-                            )
-                            self.mail_album_data.pop(album_url)
-
-
-class BCFreeDownloaderConfig:
-    def __init__(self, config_path: str):
-        self.config_path = config_path
-        self.parser = ConfigParser()
-        self.parser.read(config_path)
-        atexit.register(self.save)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
 
     def get(self, key):
         return self.parser["free-bandcamp-downloader"].get(key, None)
@@ -325,31 +101,31 @@ class BCFreeDownloaderConfig:
     def save(self):
         with open(self.config_path, "w") as f:
             self.parser.write(f)
+        self._write_cache()
 
     def __str__(self):
         return pprint.pformat(dict(self.parser["free-bandcamp-downloader"]), indent=2)
 
 
+_HOME = os.path.expanduser("~")
+
+
+def _xdg_dir(env_var: str, *fallback: str) -> str:
+    if env_var in os.environ:
+        return os.path.join(os.environ[env_var], "free-bandcamp-downloader")
+    return os.path.join(_HOME, *fallback, "free-bandcamp-downloader")
+
+
 def get_config_dir():
-    if "XDG_CONFIG_HOME" in os.environ:
-        config_dir = os.path.join(
-            os.environ["XDG_CONFIG_HOME"], "free-bandcamp-downloader"
-        )
-    else:
-        config_dir = os.path.join(
-            os.path.expanduser("~"), ".config", "free-bandcamp-downloader"
-        )
-    return config_dir
+    return _xdg_dir("XDG_CONFIG_HOME", ".config")
 
 
 def get_data_dir():
-    if "XDG_DATA_HOME" in os.environ:
-        data_dir = os.path.join(os.environ["XDG_DATA_HOME"], "free-bandcamp-downloader")
-    else:
-        data_dir = os.path.join(
-            os.path.expanduser("~"), ".local", "share", "free-bandcamp-downloader"
-        )
-    return data_dir
+    return _xdg_dir("XDG_DATA_HOME", ".local", "share")
+
+
+def get_cache_dir():
+    return _xdg_dir("XDG_CACHE_HOME", ".cache")
 
 
 def get_config(data_dir: str, config_dir: str):
@@ -360,33 +136,53 @@ def get_config(data_dir: str, config_dir: str):
         email = auto
         format = FLAC
         dir = .
-        download_history_file = {download_history_file}"""
+        download_history_file = {download_history_file}
+        parallel_downloads = 4"""
     config_file = os.path.join(config_dir, "free-bandcamp-downloader.cfg")
     if not os.path.exists(config_file):
-        if not os.path.exists(config_dir):
-            os.makedirs(config_dir)
+        os.makedirs(config_dir, exist_ok=True)
         with open(config_file, "w") as f:
             f.write(default_config)
-    if not os.path.exists(download_history_file):
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-        with open(download_history_file, "w") as f:
-            pass
-    config = BCFreeDownloaderConfig(config_file)
+    os.makedirs(data_dir, exist_ok=True)
+    # creates the history file if missing in a single syscall
+    open(download_history_file, "ab").close()
+    cache_dir = get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    config = BCFreeDownloaderConfig(config_file, os.path.join(cache_dir, "config.pkl"))
     return config
 
 
 def main():
+    argv = sys.argv[1:]
+    # short-circuit help/version before docopt rebuilds its grammar from
+    # the usage string (and before any config/dir setup)
+    if "-h" in argv or "--help" in argv:
+        print(__doc__.strip("\n"))
+        return
+    if "--version" in argv:
+        print(__version__)
+        return
+
+    from docopt import docopt
+
     data_dir = get_data_dir()
     config_dir = get_config_dir()
     config = get_config(data_dir, config_dir)
-    options = BCFreeDownloaderOptions()
     arguments = docopt(__doc__, version=__version__)
     if arguments["-a"] or arguments["-l"] or arguments["setdefault"]:
+        # the download stack (requests, lxml, mutagen, ...) is only needed
+        # here, so defer the import to keep the other subcommands fast
+        from free_bandcamp_downloader.bc_free_downloader import (
+            OPTION_ARGS,
+            OPTION_FIELDS,
+            BCFreeDownloader,
+            BCFreeDownloaderOptions,
+        )
+
+        options = BCFreeDownloaderOptions()
         # set options
-        for field in dataclasses.fields(options):
-            option = field.name
-            arg = f"--{option}"
+        for option in OPTION_FIELDS:
+            arg = OPTION_ARGS[option]
             if arguments[arg]:
                 setattr(options, option, arguments[arg][0])
             else:
@@ -408,6 +204,7 @@ def main():
             config_dir,
             config.get("download_history_file"),
             not arguments["--no-unzip"],
+            int(config.get("parallel_downloads") or 0) or None,
         )
         if arguments["-a"]:
             downloader.download_album(arguments["-a"], arguments["--force"])
@@ -417,9 +214,8 @@ def main():
         downloader.wait_for_email_downloads()
     elif arguments["setdefault"]:
         # write arguments to config
-        for field in dataclasses.fields(options):
-            option = field.name
-            arg = f"--{option}"
+        for option in OPTION_FIELDS:
+            arg = OPTION_ARGS[option]
             if arguments[arg]:
                 config.set(option, arguments[arg][0])
     elif arguments["defaults"]:
@@ -0,0 +1,521 @@
+import atexit
+import glob
+import os
+import re
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, fields
+from typing import Dict, Set, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import lxml.html
+import mutagen
+import orjson
+import pyrfc6266
+import requests
+import secmail
+from lxml import etree
+from tqdm import tqdm
+
+from free_bandcamp_downloader import logger
+
+# compiled once; grabs the first link of every release tile in a music grid
+_GRID_LINK_XPATH = etree.XPath("./li/a[1]/@href")
+_TRALBUM_XPATH = etree.XPath("//script[@data-tralbum]")
+_ARTWORK_LINK_XPATH = etree.XPath("descendant::a[1]/@href")
+
+_OG_TYPE_RE = re.compile(rb'<meta property="og:type" content="([^"]+)"')
+
+
+def _page_type(content: bytes) -> str:
+    # og:type sits within the first few KB of <head>; one regex there beats
+    # parsing the whole document just to find out this isn't an album page
+    match = _OG_TYPE_RE.search(content, 0, 8192)
+    return match.group(1).decode() if match else ""
+
+# extensions Bandcamp ships for the supported FORMATS; anything else in an
+# unzipped album (cover art, etc.) is skipped without opening the file
+_AUDIO_EXTS = {".aif", ".aiff", ".flac", ".m4a", ".mp3", ".oga", ".ogg", ".wav"}
+
+
+@dataclass
+class BCFreeDownloaderOptions:
+    country: str = None
+    zipcode: str = None
+    email: str = None
+    format: str = None
+    dir: str = None
+
+
+# resolved once at import so option handling doesn't re-introspect the
+# dataclass (and re-build Field objects) on every invocation
+OPTION_FIELDS = tuple(field.name for field in fields(BCFreeDownloaderOptions))
+OPTION_ARGS = {option: f"--{option}" for option in OPTION_FIELDS}
+
+
+@dataclass
+class BCFreeDownloaderAlbumData:
+    about: str = None
+    credits: str = None
+    tags: str = None
+
+
+class BCFreeDownloadError(Exception):
+    pass
+
+
+class _RangeNotSupported(Exception):
+    """Raised when a server answers a Range request with the full body."""
+
+
+class _ProgressReader:
+    """File-like wrapper that advances a tqdm bar as it is read."""
+
+    def __init__(self, raw, pbar):
+        self._raw = raw
+        self._pbar = pbar
+
+    def read(self, n=-1):
+        chunk = self._raw.read(n)
+        self._pbar.update(len(chunk))
+        return chunk
+
+
+class BCFreeDownloader:
+    CHUNK_SIZE = 4 * 1024 * 1024
+    MAX_WORKERS = 4
+    RANGE_SEGMENTS = 8
+    PAGE_CACHE_TTL = 60  # seconds
+    PAGE_CACHE_SIZE = 64  # entries
+    LINK_REGEX = re.compile(r'<a href="(?P<url>[^"]*)">', re.ASCII)
+    RETRY_URL_REGEX = re.compile(rb'"retry_url":"(?P<retry_url>[^"]*)"')
+    FORMATS = {
+        "FLAC": "flac",
+        "V0MP3": "mp3-v0",
+        "320MP3": "mp3-320",
+        "AAC": "aac-hi",
+        "Ogg": "vorbis",
+        "ALAC": "alac",
+        "WAV": "wav",
+        "AIFF": "aiff-lossless",
+    }
+
+    def __init__(
+        self,
+        options: BCFreeDownloaderOptions,
+        config_dir: str,
+        download_history_file: str,
+        unzip: bool = True,
+        max_workers: int = None,
+    ):
+        self.options = options
+        self.config_dir = config_dir
+        self.download_history_file = download_history_file
+        self.max_workers = max_workers or self.MAX_WORKERS
+        self.downloaded: Set[str] = set()
+        self._history_file = None
+        self._history_lock = threading.Lock()
+        self.mail_session = None
+        self.mail_album_data: Dict[str, BCFreeDownloaderAlbumData] = {}
+        self.unzip = unzip
+        self.session = None
+        self._init_email()
+        self._init_downloaded()
+        self._init_session()
+
+    def _init_email(self):
+        if not self.options.email or self.options.email == "auto":
+            self.mail_session = secmail.Client(self.config_dir)
+            self.options.email = self.mail_session.random_email(1, "1secmail.com")[0]
+
+    def _init_downloaded(self):
+        if self.download_history_file:
+            with open(self.download_history_file, "rb", buffering=1 << 20) as f:
+                data = f.read()
+            for line in data.splitlines():
+                self.downloaded.add(line.decode())
+            self._history_file = open(
+                self.download_history_file, "a", buffering=64 * 1024
+            )
+            atexit.register(self._history_file.close)
+
+    def _init_session(self):
+        self.session = requests.Session()
+        # with max_workers releases each fetching RANGE_SEGMENTS segments,
+        # urllib3's default pool of 10 would discard connections and force
+        # fresh TLS handshakes; size it for the worst-case concurrency
+        pool_size = self.max_workers * self.RANGE_SEGMENTS
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # cache page fetches so overlapping inputs (e.g. a label page
+        # listing an album that is fetched again) hit the network once;
+        # entries expire so long runs don't serve stale pages
+        self._page_cache: Dict[str, Tuple[float, bytes]] = {}
+        self._page_cache_lock = threading.Lock()
+
+    def _get_page(self, url: str) -> bytes:
+        with self._page_cache_lock:
+            cached = self._page_cache.get(url)
+            if cached:
+                if time.monotonic() - cached[0] < self.PAGE_CACHE_TTL:
+                    return cached[1]
+                del self._page_cache[url]
+        r = self.session.get(url)
+        r.raise_for_status()
+        # keep the raw bytes; Bandcamp serves UTF-8, so skip r.text's decode
+        content = r.content
+        with self._page_cache_lock:
+            now = time.monotonic()
+            # drop everything stale, then the oldest entries if still full,
+            # so a long label run doesn't keep every page body resident
+            for cached_url in [
+                u
+                for u, (ts, _) in self._page_cache.items()
+                if now - ts >= self.PAGE_CACHE_TTL
+            ]:
+                del self._page_cache[cached_url]
+            while len(self._page_cache) >= self.PAGE_CACHE_SIZE:
+                # dicts iterate in insertion order, so this is the oldest
+                del self._page_cache[next(iter(self._page_cache))]
+            self._page_cache[url] = (now, content)
+        return content
+
+    def _download_ranged(self, download_url: str, file_name: str, size: int):
+        # bcbits serves byte ranges; fetch fixed-size segments in parallel
+        # and write each at its own offset with pwrite (thread-safe, no lock)
+        segment = -(-size // self.RANGE_SEGMENTS)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+        fd = os.open(file_name, flags)
+        try:
+            os.ftruncate(fd, size)
+            with tqdm(total=size, unit="iB", unit_scale=True) as pbar:
+                pbar_lock = threading.Lock()
+
+                def fetch(offset: int):
+                    end = min(offset + segment, size) - 1
+                    headers = {"Range": f"bytes={offset}-{end}"}
+                    with self.session.get(
+                        download_url, headers=headers, stream=True
+                    ) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            # a 200 carries the whole body; pwriting full
+                            # copies at eight offsets would silently corrupt
+                            # the file
+                            raise _RangeNotSupported(download_url)
+                        for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                            with pbar_lock:
+                                pbar.update(len(chunk))
+
+                with ThreadPoolExecutor(max_workers=self.RANGE_SEGMENTS) as executor:
+                    futures = [
+                        executor.submit(fetch, offset)
+                        for offset in range(0, size, segment)
+                    ]
+                    for future in as_completed(futures):
+                        future.result()
+        finally:
+            os.close(fd)
+
+    def _download_file(
+        self,
+        download_page_url: str,
+        format: str,
+        album_data: BCFreeDownloaderAlbumData = None,
+    ) -> str:
+        r = self.session.get(download_page_url)
+        r.raise_for_status()
+        tree = lxml.html.fromstring(r.content)
+        album_url = _ARTWORK_LINK_XPATH(tree.find_class("download-artwork")[0])[0]
+        if album_data is None:
+            album_data = self.mail_album_data[album_url]
+
+        # pagedata comes from lxml's O(1) id index rather than a tree walk
+        data = orjson.loads(tree.get_element_by_id("pagedata").get("data-blob"))
+        download_url = data["digital_items"][0]["downloads"][self.FORMATS[format]][
+            "url"
+        ]
+
+        def stream(r, file_name: str, size: int) -> str:
+            # delegate the copy loop to C instead of iter_content round
+            # trips through the interpreter per chunk
+            r.raw.decode_content = True
+            with tqdm(total=size, unit="iB", unit_scale=True) as pbar:
+                with open(file_name, "wb", buffering=self.CHUNK_SIZE) as f:
+                    shutil.copyfileobj(
+                        _ProgressReader(r.raw, pbar), f, length=self.CHUNK_SIZE
+                    )
+            return file_name
+
+        def download(download_url: str) -> str:
+            with self.session.get(download_url, stream=True) as r:
+                r.raise_for_status()
+                size = int(r.headers["content-length"])
+                name = pyrfc6266.requests_response_to_filename(r)
+                file_name = os.path.join(self.options.dir, name)
+                if (
+                    hasattr(os, "pwrite")  # offset writes are Unix-only
+                    and r.headers.get("accept-ranges") == "bytes"
+                    and size > self.CHUNK_SIZE
+                ):
+                    # a single TCP stream rarely fills a fat, high-latency
+                    # link; re-fetch the body as parallel ranged segments
+                    r.close()
+                    try:
+                        self._download_ranged(download_url, file_name, size)
+                        return file_name
+                    except _RangeNotSupported:
+                        logger.info(
+                            f"Server ignored a Range request, downloading {name}"
+                            " on a single stream"
+                        )
+                        with self.session.get(download_url, stream=True) as r2:
+                            r2.raise_for_status()
+                            return stream(r2, file_name, size)
+                return stream(r, file_name, size)
+
+        try:
+            file_name = download(download_url)
+        except:
+            statdownload_url = download_url.replace("/download/", "/statdownload/")
+            with self.session.get(statdownload_url) as r:
+                r.raise_for_status()
+                download_url = (
+                    self.RETRY_URL_REGEX.search(r.content).group("retry_url").decode()
+                )
+            file_name = download(download_url)
+
+        logger.info(f"Downloaded {file_name}")
+
+        if file_name.endswith("zip") and self.unzip:
+            # Unzip archive
+            dir_name = file_name[:-4]
+            self._unzip(file_name, dir_name)
+            logger.info(f"Unzipped to {dir_name}. Use --no-unzip to prevent this")
+            os.remove(file_name)
+            files = glob.glob(os.path.join(dir_name, "*"))
+        else:
+            files = [file_name]
+        # Tag downloaded audio files with url & comment
+        logger.info("Setting tags...")
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [
+                executor.submit(self._tag_file, file, album_url, album_data)
+                for file in files
+            ]
+            for future in as_completed(futures):
+                future.result()
+        # successfully downloaded file, add to download history
+        with self._history_lock:
+            self.downloaded.add(album_url)
+            if self._history_file:
+                self._history_file.write(f"{album_url}\n")
+                # one flushed append per release; a crash mid-run then costs
+                # at most the release in flight, never the whole history
+                self._history_file.flush()
+
+        return album_url
+
+    @staticmethod
+    def _tag_file(file: str, album_url: str, album_data: BCFreeDownloaderAlbumData):
+        if os.path.splitext(file)[1].lower() not in _AUDIO_EXTS:
+            return
+        f = mutagen.File(file)
+        if f is None:
+            return
+        f["website"] = album_url
+        if album_data.tags:
+            f["genre"] = album_data.tags
+        comment = ""
+        if album_data.about:
+            comment += album_data.about
+        if album_data.about and album_data.credits:
+            comment += "\n\n"
+        if album_data.credits:
+            comment += album_data.credits
+        f["comment"] = comment
+        try:
+            # keep some slack in the tag block so the write never has to
+            # relocate the audio payload (a full-file rewrite)
+            f.save(padding=lambda info: max(info.padding, 4096))
+        except TypeError:
+            # not every container's save() accepts a padding callback
+            f.save()
+
+    @staticmethod
+    def _unzip(file_name: str, dir_name: str):
+        # zlib releases the GIL while inflating, so members decompress in
+        # parallel; ZipFile handles aren't thread-safe, so each worker opens
+        # its own (cheap, the OS page cache still holds the archive)
+        with zipfile.ZipFile(file_name, "r") as f:
+            members = f.namelist()
+
+        # ZipFile.extract creates missing directories with a non-atomic
+        # exists/makedirs pair, so build the target tree before the workers
+        # race each other to do it
+        os.makedirs(dir_name, exist_ok=True)
+        for member in members:
+            subdir = os.path.dirname(member)
+            if subdir:
+                os.makedirs(os.path.join(dir_name, subdir), exist_ok=True)
+
+        def extract(member):
+            with zipfile.ZipFile(file_name, "r") as f:
+                f.extract(member, dir_name)
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(extract, member) for member in members]
+            for future in as_completed(futures):
+                future.result()
+
+    @staticmethod
+    def _get_album_data_from_tree(
+        tree: lxml.html.HtmlElement,
+    ) -> BCFreeDownloaderAlbumData:
+        album_data = BCFreeDownloaderAlbumData()
+
+        def div_text(class_name):
+            divs = [el for el in tree.find_class(class_name) if el.tag == "div"]
+            return "\n".join(divs[0].itertext()) if divs else None
+
+        album_data.about = div_text("tralbum-about")
+        album_data.credits = div_text("tralbum-credits")
+        tags = [el.text_content() for el in tree.find_class("tag") if el.tag == "a"]
+        album_data.tags = ",".join(sorted(tags))
+        return album_data
+
+    def download_album(self, url: str, force: bool = False):
+        # Remove url params
+        url = urlsplit(url).geturl()
+        if url in self.downloaded and not force:
+            raise BCFreeDownloadError(
+                f"{url} already downloaded. To download anyways, use option --force"
+            )
+        content = self._get_page(url)
+        page_type = _page_type(content)
+        if page_type and page_type not in ("album", "song"):
+            raise BCFreeDownloadError(
+                f"{url} is a {page_type} page, not an album. Use -l for label pages"
+            )
+        tree = lxml.html.fromstring(content)
+        album_data = self._get_album_data_from_tree(tree)
+
+        logger.debug(f"Album data: {album_data}")
+
+        tralbum_data = _TRALBUM_XPATH(tree)[0].get("data-tralbum")
+        tralbum_data = orjson.loads(tralbum_data)
+
+        if tralbum_data["current"]["minimum_price"] == 0:
+            if tralbum_data["current"]["require_email"]:
+                logger.info(f"{url} requires email")
+                email_post_url = urljoin(url, "/email_download")
+                r = self.session.post(
+                    email_post_url,
+                    data={
+                        "encoding_name": "none",
+                        "item_id": tralbum_data["current"]["id"],
+                        "item_type": tralbum_data["current"]["type"],
+                        "address": self.options.email,
+                        "country": self.options.country,
+                        "postcode": self.options.zipcode,
+                    },
+                )
+                r.raise_for_status()
+                r = r.json()
+                if not r["ok"]:
+                    raise ValueError(f"Bad response when sending email address: {r}")
+                self.mail_album_data[url] = album_data
+            else:
+                logger.info(f"{url} does not require email")
+                if not tralbum_data["freeDownloadPage"]:
+                    logger.warning(
+                        "Album has no download link (probably has no tracks). Skipping..."
+                    )
+                    return
+                self._download_file(
+                    tralbum_data["freeDownloadPage"], self.options.format, album_data
+                )
+        else:
+            raise BCFreeDownloadError(f"{url} is not free")
+
+    def download_label(self, url: str, force: bool = False):
+        tree = lxml.html.fromstring(self._get_page(url))
+        grid = tree.get_element_by_id("music-grid")
+        albums = list(_GRID_LINK_XPATH(grid))
+        client_items = grid.get("data-client-items")
+        if client_items is not None:
+            # lxml already unescaped the attribute entities
+            albums += [obj["page_url"] for obj in orjson.loads(client_items)]
+        # the grid and data-client-items can list the same release; dedupe
+        # (order-preserving) once resolved so each page is fetched at most once
+        albums = dict.fromkeys(urljoin(url, album_link) for album_link in albums)
+
+        def download(album_link):
+            logger.info(f"Downloading {album_link}")
+            try:
+                self.download_album(album_link, force)
+            except BCFreeDownloadError as ex:
+                logger.info(ex)
+
+        # skip known releases up front so they don't occupy pool slots
+        pending = [
+            album_link
+            for album_link in albums
+            if force or album_link not in self.downloaded
+        ]
+        if len(pending) < len(albums):
+            logger.info(
+                f"Skipping {len(albums) - len(pending)} already downloaded releases"
+            )
+        # each release is an independent I/O-bound download, so overlap them
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(download, album_link) for album_link in pending]
+            for future in as_completed(futures):
+                future.result()
+
+    def wait_for_email_downloads(self):
+        checked_ids = set()
+        seen_urls = set()
+        pending = len(self.mail_album_data)
+        futures = []
+        # start each download the moment its email lands and keep polling,
+        # instead of blocking the poll loop for the whole download
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending > 0:
+                logger.info(f"Waiting for {pending} emails from Bandcamp...")
+                time.sleep(5)
+                for email in self.mail_session.get_inbox(self.options.email):
+                    if email.id not in checked_ids:
+                        checked_ids.add(email.id)
+                        if (
+                            email.from_address.endswith("@email.bandcamp.com")
+                            and "download" in email.subject
+                        ):
+                            logger.info(f'Received email "{email.subject}"')
+                            email = self.mail_session.get_message(
+                                self.options.email, email.id
+                            )
+                            match = self.LINK_REGEX.search(email.html_body)
+                            # dedupe on the link itself: a re-sent mail has
+                            # a fresh id but the same download URL, and must
+                            # not count against another album's email
+                            if match and match.group("url") not in seen_urls:
+                                seen_urls.add(match.group("url"))
+                                futures.append(
+                                    executor.submit(
+                                        self._download_file,
+                                        match.group("url"),
+                                        self.options.format,
+                                    )
+                                )
+                                pending -= 1
+            for future in as_completed(futures):
+                self.mail_album_data.pop(future.result())